@@ -6,6 +6,48 @@ class BatchBase(object):
     Базовый класс для формирования батч-запрсов.
     """
 
+    def record_set(self, partition: List[str], clustering: List[str], new_value: Optional[any],
+                   reindex: bool, n: int, r: int, w: int, entry=None):
+        """
+        Добавляет set-запрос в батч, не дожидаясь его выполнения.
+        :param partition: распределительный ключ
+        :param clustering: сортируемый ключ
+        :param new_value: новое значение
+        :param reindex: переиндексировать ключ с новым значением?
+        :param n: количество реплик
+        :param r: количество ответов для подтверждения чтения
+        :param w: количество ответов для подтверждения записи
+        :param entry: Entry, в котором после выполнения батча запоминаются новые значение и версия
+        :return: запись батча, из которой после выполнения можно получить новую версию (new_version)
+        """
+        raise NotImplementedError()
+
+    def record_cas(self, partition: List[str], clustering: List[str], new_value: Optional[any],
+                   old_version: int, reindex: bool, n: int, r: int, w: int, entry=None):
+        """
+        Добавляет cas-запрос в батч, не дожидаясь его выполнения.
+        :param partition: распределительный ключ
+        :param clustering: сортируемый ключ
+        :param new_value: новое значение
+        :param old_version: версия для сравнения
+        :param reindex: переиндексировать ключ с новым значением?
+        :param n: количество реплик
+        :param r: количество ответов для подтверждения чтения
+        :param w: количество ответов для подтверждения записи
+        :param entry: Entry, в котором после выполнения батча запоминаются новые значение и версия
+        :return: запись батча, из которой после выполнения можно получить новую версию (new_version)
+        """
+        raise NotImplementedError()
+
+    async def wait(self):
+        """
+        Ожидает выполнения батча.
+        :raise CasError: когда текущая версия значения не совпала с указанной
+        :raise TimeoutError: когда время ожидания запроса истекло
+        :raise KvError: когда произошла неизвестная ошибка на сервере
+        """
+        raise NotImplementedError()
+
     async def set(self, partition: List[str], clustering: List[str], new_value: Optional[any],
                   reindex: bool, n: int, r: int, w: int) -> int:
         """
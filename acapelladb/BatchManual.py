@@ -4,113 +4,201 @@ from typing import List, Optional, Dict, Tuple
 import asyncio
 
 from acapelladb.BatchBase import BatchBase
-from acapelladb.utils.http import AsyncSession, key_to_str, raise_if_error
+from acapelladb.Entry import Entry
+from acapelladb.utils.http import AsyncSession, partition_url, raise_if_error, JSON_HEADERS
+from acapelladb.utils.serialization import dumps
 
 
 class BatchEntry(object):
-    def __init__(self, new_value: Optional[any], old_version: Optional[int], reindex: bool):
-        self.new_value = new_value
-        self.old_version = old_version
-        self.reindex = reindex
-        self.new_version = 0  # for response
+    __slots__ = ('_batch', '_index')
+
+    def __init__(self, batch: 'PartitionBatch', index: int):
+        self._batch = batch
+        self._index = index
+
+    @property
+    def new_version(self) -> int:
+        return self._batch.new_versions[self._index]
 
 
 class PartitionBatch(object):
+    __slots__ = ('n', 'r', 'w', 'keys', 'new_values', 'old_versions', 'new_versions', 'entries', '_reindex',
+                 '_index')
+
     def __init__(self, n: int, r: int, w: int):
         self.n = n
         self.r = r
         self.w = w
-        self.batch: Dict[Tuple[str, ...], BatchEntry] = {}
-
-    def set(self, clustering: List[str], new_value: Optional[any], reindex: bool) -> BatchEntry:
-        key = tuple(clustering)
-        entry = BatchEntry(new_value, None, reindex)
-        self.__assert_not_set(key)
-        self.batch[key] = entry
-        return entry
-
-    def cas(self, clustering: List[str], new_value: Optional[any], old_version: int, reindex: bool) -> BatchEntry:
-        key = tuple(clustering)
-        entry = BatchEntry(new_value, old_version, reindex)
-        self.__assert_not_set(key)
-        self.batch[key] = entry
-        return entry
+        # записи батча хранятся в параллельных списках, связанных общим индексом
+        self.keys: List[Tuple[str, ...]] = []
+        self.new_values: List[Optional[any]] = []
+        self.old_versions: List[Optional[int]] = []
+        self.new_versions: List[int] = []  # for response
+        self.entries: List[Optional[Entry]] = []  # получают новые значение и версию из ответа
+        self._reindex = False
+        self._index: Dict[Tuple[str, ...], int] = {}
+
+    def set(self, clustering: List[str], new_value: Optional[any], reindex: bool,
+            entry: Optional[Entry]) -> BatchEntry:
+        return self._add(tuple(clustering), new_value, None, reindex, entry)
+
+    def cas(self, clustering: List[str], new_value: Optional[any], old_version: int, reindex: bool,
+            entry: Optional[Entry]) -> BatchEntry:
+        return self._add(tuple(clustering), new_value, old_version, reindex, entry)
 
     def need_reindex(self) -> bool:
-        return any([e.reindex for e in self.batch.values()])
+        return self._reindex
+
+    def idempotent(self) -> bool:
+        # повтор CAS, который уже выполнился на сервере, завершился бы ошибкой CAS
+        return all(v is None for v in self.old_versions)
 
     def build_request_body(self) -> object:
         return [
             {
                 'key': k,
-                'value': e.new_value,
-                'version': e.old_version
+                'value': v,
+                'version': ov
             }
-            for k, e in self.batch.items()
+            for k, v, ov in zip(self.keys, self.new_values, self.old_versions)
         ]
 
     def apply_response(self, body: List[dict]):
-        assert len(body) == len(self.batch)
+        assert len(body) == len(self.keys)
 
+        index = self._index
+        new_versions = self.new_versions
         for item in body:
-            key = tuple(item['key'])
-            new_version = item['version']
-            self.batch[key].new_version = new_version
-
-    def __assert_not_set(self, clustering: Tuple[str, ...]):
-        assert clustering not in self.batch, "Key can be added to batch only one time"
+            new_versions[index[tuple(item['key'])]] = item['version']
+
+        for entry, version, value in zip(self.entries, new_versions, self.new_values):
+            if entry is not None:
+                entry._apply_batch(version, value)
+
+    def _add(self, key: Tuple[str, ...], new_value: Optional[any], old_version: Optional[int],
+             reindex: bool, entry: Optional[Entry]) -> BatchEntry:
+        assert key not in self._index, "Key can be added to batch only one time"
+        i = len(self.keys)
+        self._index[key] = i
+        self.keys.append(key)
+        self.new_values.append(new_value)
+        self.old_versions.append(old_version)
+        self.new_versions.append(0)
+        self.entries.append(entry)
+        self._reindex = self._reindex or reindex
+        return BatchEntry(self, i)
 
 
 class BatchManual(BatchBase):
-    def __init__(self, session: AsyncSession, api_prefix: str):
+    def __init__(self, session: AsyncSession, api_prefix: str, multi_partition: bool = False):
         self._session = session
+        self._multi_partition = multi_partition
         self._future = Future()
         self._in_process = True
         self._batch: Dict[Tuple[str, ...], PartitionBatch] = {}
         self._api_prefix = api_prefix
 
+    def record_set(self, partition: List[str], clustering: List[str], new_value: Optional[any],
+                   reindex: bool, n: int, r: int, w: int, entry: Optional[Entry] = None) -> BatchEntry:
+        self._assert_in_process()
+        return self._partition_batch(partition, n, r, w).set(clustering, new_value, reindex, entry)
+
+    def record_cas(self, partition: List[str], clustering: List[str], new_value: Optional[any], old_version: int,
+                   reindex: bool, n: int, r: int, w: int, entry: Optional[Entry] = None) -> BatchEntry:
+        self._assert_in_process()
+        return self._partition_batch(partition, n, r, w).cas(clustering, new_value, old_version, reindex, entry)
+
+    async def wait(self):
+        # shield, чтобы отмена одного из ожидающих не отменяла батч для остальных
+        await asyncio.shield(self._future)
+
     async def set(self, partition: List[str], clustering: List[str], new_value: Optional[any],
                   reindex: bool, n: int, r: int, w: int) -> int:
-        self._assert_in_process()
-        partition_batch = self._batch.setdefault(tuple(partition), PartitionBatch(n, r, w))
-        entry = partition_batch.set(clustering, new_value, reindex)
-        await self._future
+        entry = self.record_set(partition, clustering, new_value, reindex, n, r, w)
+        await self.wait()
         return entry.new_version
 
     async def cas(self, partition: List[str], clustering: List[str], new_value: Optional[any], old_version: int,
                   reindex: bool, n: int, r: int, w: int) -> int:
-        self._assert_in_process()
-        partition_batch = self._batch.setdefault(tuple(partition), PartitionBatch(n, r, w))
-        entry = partition_batch.cas(clustering, new_value, old_version, reindex)
-        await self._future
+        entry = self.record_cas(partition, clustering, new_value, old_version, reindex, n, r, w)
+        await self.wait()
         return entry.new_version
 
     async def send(self):
-        # если в батче ничего нет, то скорее всего все запросы были
-        # закинуты в event-loop и ещё не выполнились, так что нужно
-        # дать им возможность это сделать
-        if len(self._batch) == 0:
-            # более-менее стандартный способ сделать yield
-            await asyncio.sleep(0)
-
         self._in_process = False
-        requests = []
 
-        for k, b in self._batch.items():
-            requests.append(self._send_partition(k, b))
-        for request in requests:
-            await request
+        try:
+            # по умолчанию - отдельный запрос на каждый partition; одним запросом батч с несколькими
+            # partition'ами отправляется, только если это явно включено в Session
+            if self._multi_partition and len(self._batch) > 1:
+                await self._send_multi_partition()
+            else:
+                await self._send_partitions()
+        except asyncio.CancelledError:
+            self._future.cancel()
+            raise
+        except Exception as e:
+            # пробрасываем исключение всем, кто ожидает выполнения батча; вызывающий send() и так
+            # получит исключение, поэтому оно помечается полученным, даже если результатов никто не ждёт
+            self._future.set_exception(e)
+            self._future.exception()
+            raise
 
         self._future.set_result(None)
 
+    async def _send_partitions(self):
+        if len(self._batch) == 1:
+            # для одного partition'а нет смысла создавать отдельные задачи
+            for k, b in self._batch.items():
+                await self._send_partition(k, b)
+            return
+
+        requests = [asyncio.ensure_future(self._send_partition(k, b)) for k, b in self._batch.items()]
+        try:
+            await asyncio.gather(*requests)
+        except BaseException:
+            # при первой ошибке отменяем оставшиеся запросы
+            for request in requests:
+                request.cancel()
+            raise
+
+    async def _send_multi_partition(self):
+        batches = list(self._batch.items())
+        url = f'{self._api_prefix}/v2/kv/multi-partition-batch'
+        response = await self._session.put(url, data=dumps([
+            {
+                'partition': partition,
+                'n': batch.n,
+                'r': batch.r,
+                'w': batch.w,
+                'reindex': batch.need_reindex(),
+                'entries': batch.build_request_body()
+            }
+            for partition, batch in batches
+        ]), headers=JSON_HEADERS, idempotent=all(batch.idempotent() for _, batch in batches))
+        raise_if_error(response.status)
+
+        body = await response.json()
+        assert len(body) == len(batches)
+        for (_, batch), entries in zip(batches, body):
+            batch.apply_response(entries)
+
+    def _partition_batch(self, partition: List[str], n: int, r: int, w: int) -> PartitionBatch:
+        key = tuple(partition)
+        partition_batch = self._batch.get(key)
+        if partition_batch is None:
+            partition_batch = PartitionBatch(n, r, w)
+            self._batch[key] = partition_batch
+        return partition_batch
+
     async def _send_partition(self, partition: Tuple[str, ...], batch: PartitionBatch):
-        url = f'{self._api_prefix}/v2/kv/partition/{key_to_str(partition)}'
+        url = partition_url(self._api_prefix, partition)
         response = await self._session.put(url, params={
             'n': batch.n,
             'r': batch.r,
             'w': batch.w,
             'reindex': str(batch.need_reindex())
-        }, json=batch.build_request_body())
+        }, data=dumps(batch.build_request_body()), headers=JSON_HEADERS, idempotent=batch.idempotent())
         raise_if_error(response.status)
         batch.apply_response(await response.json())
 
@@ -1,7 +1,7 @@
 from typing import List, Optional
 
 from acapelladb.utils.collections import remove_none_values
-from acapelladb.utils.http import AsyncSession, key_to_str, raise_if_error
+from acapelladb.utils.http import AsyncSession, raise_if_error, cursor_url
 from acapelladb.utils.assertion import check_key, check_nrw
 
 
@@ -22,6 +22,7 @@ class Cursor(object):
         self._w = w
         self._transaction = transaction
         self._api_prefix = api_prefix
+        self._url = cursor_url(api_prefix, tree, key)
 
     async def get(self) -> Optional[any]:
         """
@@ -36,7 +37,7 @@ class Cursor(object):
         :raise KvError: когда произошла неизвестная ошибка на сервере
         """
         response = await self._session.get(
-            f'{self._api_prefix}/v2/dt/{key_to_str(self._tree)}/keys/{key_to_str(self._key)}',
+            self._url,
             params=remove_none_values({
                 'n': self._n,
                 'r': self._r,
@@ -66,7 +67,7 @@ class Cursor(object):
         :raise KvError: когда произошла неизвестная ошибка на сервере
         """
         response = await self._session.put(
-            f'{self._api_prefix}/v2/dt/{key_to_str(self._tree)}/keys/{key_to_str(self._key)}',
+            self._url,
             params=remove_none_values({
                 'n': self._n,
                 'r': self._r,
@@ -94,7 +95,7 @@ class Cursor(object):
         :raise KvError: когда произошла неизвестная ошибка на сервере
         """
         response = await self._session.get(
-            f'{self._api_prefix}/v2/dt/{key_to_str(self._tree)}/keys/{key_to_str(self._key)}/next',
+            self._url + '/next',
             params=remove_none_values({
                 'n': self._n,
                 'r': self._r,
@@ -122,7 +123,7 @@ class Cursor(object):
         :raise KvError: когда произошла неизвестная ошибка на сервере
         """
         response = await self._session.get(
-            f'{self._api_prefix}/v2/dt/{key_to_str(self._tree)}/keys/{key_to_str(self._key)}/prev',
+            self._url + '/prev',
             params=remove_none_values({
                 'n': self._n,
                 'r': self._r,
@@ -1,8 +1,6 @@
 from datetime import timedelta
 from typing import List, Optional, Awaitable, Callable
 
-import asyncio
-
 from acapelladb.BatchBase import BatchBase
 from acapelladb.utils.assertion import check_key, check_nrw
 from acapelladb.utils.collections import remove_none_values
@@ -10,6 +8,9 @@ from acapelladb.utils.http import AsyncSession, raise_if_error, entry_url
 
 
 class Entry(object):
+    __slots__ = ('_session', '_partition', '_clustering', '_version', '_value', '_n', '_r', '_w', '_transaction',
+                 '_api_prefix', '_url', '_base_params')
+
     def __init__(self, session: AsyncSession, api_prefix: str, partition: List[str], clustering: List[str],
                  version: int, value: Optional[any], n: int, r: int, w: int, transaction: Optional[int]):
         """
@@ -17,6 +18,21 @@ class Entry(object):
         """
         check_key(partition)
         check_nrw(n, r, w)
+        self._init(session, api_prefix, partition, clustering, version, value, n, r, w, transaction)
+
+    @classmethod
+    def _unchecked(cls, session: AsyncSession, api_prefix: str, partition: List[str], clustering: List[str],
+                   version: int, value: Optional[any], n: int, r: int, w: int, transaction: Optional[int]) -> 'Entry':
+        """
+        Создание Entry без проверки ключа и параметров N/R/W.
+        Используется, когда параметры уже проверены вызывающим кодом, например при разборе выборки.
+        """
+        entry = cls.__new__(cls)
+        entry._init(session, api_prefix, partition, clustering, version, value, n, r, w, transaction)
+        return entry
+
+    def _init(self, session: AsyncSession, api_prefix: str, partition: List[str], clustering: List[str],
+              version: int, value: Optional[any], n: int, r: int, w: int, transaction: Optional[int]):
         self._session = session
         self._partition = partition
         self._clustering = clustering
@@ -27,6 +43,13 @@ class Entry(object):
         self._w = w
         self._transaction = transaction
         self._api_prefix = api_prefix
+        self._url = entry_url(api_prefix, partition, clustering)
+        self._base_params = remove_none_values({
+            'n': n,
+            'r': r,
+            'w': w,
+            'transaction': transaction,
+        })
 
     async def get(self, watch: bool = False) -> Optional[any]:
         """
@@ -40,14 +63,7 @@ class Entry(object):
         :raise TransactionCompletedError: когда транзакция, в которой выполняется операция, уже завершена
         :raise KvError: когда произошла неизвестная ошибка на сервере
         """
-        url = entry_url(self._api_prefix, self._partition, self._clustering)
-        response = await self._session.get(url, params=remove_none_values({
-            'n': self._n,
-            'r': self._r,
-            'w': self._w,
-            'transaction': self._transaction,
-            'watch': str(watch),
-        }))
+        response = await self._session.get(self._url, params={**self._base_params, 'watch': str(watch)})
         raise_if_error(response.status)
         body = await response.json()
         self._version = int(body['version'])
@@ -69,17 +85,14 @@ class Entry(object):
         """
         if wait_version is None:
             wait_version = self._version
-        timeout_seconds = int(timeout.total_seconds()) if timeout is not None else None
-
-        url = entry_url(self._api_prefix, self._partition, self._clustering)
-        response = await self._session.get(url, params=remove_none_values({
-            'n': self._n,
-            'r': self._r,
-            'w': self._w,
-            'transaction': self._transaction,
-            'waitVersion': wait_version,
-            'waitTimeout': timeout_seconds,
-        }))
+
+        params = {**self._base_params, 'waitVersion': wait_version}
+        wait = None
+        if timeout is not None:
+            wait = int(timeout.total_seconds())
+            params['waitTimeout'] = wait
+        # запрос висит на сервере всё время ожидания, обычный таймаут чтения его бы оборвал
+        response = await self._session.get(self._url, params=params, timeout=self._session.long_poll_timeout(wait))
         raise_if_error(response.status)
 
         body = await response.json()
@@ -104,20 +117,14 @@ class Entry(object):
         """
         return single_or_batch(batch, self._set_single, self._set_batch, new_value, reindex)
 
-    async def _set_batch(self, batch: BatchBase, new_value: Optional[any], reindex: bool):
-        self._version = await batch.set(self.partition, self.clustering, new_value, reindex, self._n, self._r, self._w)
-        self._value = new_value
-        return self._version
+    def _set_batch(self, batch: BatchBase, new_value: Optional[any], reindex: bool) -> Awaitable[int]:
+        batch_entry = batch.record_set(self._partition, self._clustering, new_value, reindex,
+                                       self._n, self._r, self._w, self)
+        return BatchResult(batch, batch_entry)
 
     async def _set_single(self, new_value: Optional[any], reindex: bool):
-        url = entry_url(self._api_prefix, self._partition, self._clustering)
-        response = await self._session.put(url, params=remove_none_values({
-            'n': self._n,
-            'r': self._r,
-            'w': self._w,
-            'transaction': self._transaction,
-            'reindex': str(reindex),
-        }), json=new_value)
+        response = await self._session.put(self._url, params={**self._base_params, 'reindex': str(reindex)},
+                                           json=new_value)
         raise_if_error(response.status)
         body = await response.json()
         self._version = int(body['version'])
@@ -144,29 +151,31 @@ class Entry(object):
             old_version = self._version
         return single_or_batch(batch, self._cas_single, self._cas_batch, new_value, old_version, reindex)
 
-    async def _cas_batch(self, batch: BatchBase, new_value: Optional[any], old_version: int, reindex: bool):
-        self._version = await batch.cas(
-            self.partition, self.clustering, new_value, old_version, reindex, self._n, self._r, self._w
-        )
-        self._value = new_value
-        return self._version
+    def _cas_batch(self, batch: BatchBase, new_value: Optional[any], old_version: int,
+                   reindex: bool) -> Awaitable[int]:
+        batch_entry = batch.record_cas(self._partition, self._clustering, new_value, old_version, reindex,
+                                       self._n, self._r, self._w, self)
+        return BatchResult(batch, batch_entry)
 
     async def _cas_single(self, new_value: Optional[any], old_version: int, reindex: bool):
-        url = entry_url(self._api_prefix, self._partition, self._clustering)
-        response = await self._session.put(url, params=remove_none_values({
-            'n': self._n,
-            'r': self._r,
-            'w': self._w,
-            'transaction': self._transaction,
+        response = await self._session.put(self._url, params={
+            **self._base_params,
             'oldVersion': old_version,
             'reindex': str(reindex),
-        }), json=new_value)
+        }, json=new_value, idempotent=False)
         raise_if_error(response.status)
         body = await response.json()
         self._version = int(body['version'])
         self._value = new_value
         return self._version
 
+    def _apply_batch(self, version: int, new_value: Optional[any]):
+        """
+        Запоминает результат операции в батче. Вызывается батчем при получении ответа сервера.
+        """
+        self._version = version
+        self._value = new_value
+
     @property
     def value(self) -> Optional[any]:
         """
@@ -196,8 +205,63 @@ class Entry(object):
         return self._clustering
 
 
+class BatchResult(object):
+    """
+    Новая версия после выполнения операции в батче. Отдельная задача на каждую операцию не создаётся,
+    а новые значение и версия запоминаются в Entry самим батчем, даже если результат не ожидается.
+    """
+    __slots__ = ('_batch', '_batch_entry')
+
+    def __init__(self, batch: BatchBase, batch_entry):
+        self._batch = batch
+        self._batch_entry = batch_entry
+
+    def __await__(self):
+        return self._wait().__await__()
+
+    async def _wait(self) -> int:
+        await self._batch.wait()
+        return self._batch_entry.new_version
+
+
+class EntryView(object):
+    """
+    Облегчённое представление ключа из результата выборки: только сортируемый ключ и значение.
+    Полноценный Entry создаётся по требованию через to_entry().
+    """
+    __slots__ = ('clustering', 'value', '_session', '_api_prefix', '_partition')
+
+    def __init__(self, session: AsyncSession, api_prefix: str, partition: List[str], clustering: List[str],
+                 value: Optional[any]):
+        self.clustering = clustering
+        self.value = value
+        self._session = session
+        self._api_prefix = api_prefix
+        self._partition = partition
+
+    @property
+    def partition(self) -> List[str]:
+        """
+        :return: распределительный ключ
+        """
+        return self._partition
+
+    def to_entry(self, n: int = 3, r: int = 2, w: int = 2) -> Entry:
+        """
+        Создание Entry для этого ключа вне транзакции. Не выполняет никаких запросов.
+        :param n: количество реплик
+        :param r: количество ответов для подтверждения чтения
+        :param w: количество ответов для подтверждения записи
+        :return: Entry для этого ключа с полученным значением
+        """
+        check_nrw(n, r, w)
+        # partition проверен при создании PartitionIndex
+        return Entry._unchecked(self._session, self._api_prefix, self._partition, self.clustering, 0, self.value,
+                                n, r, w, None)
+
+
 def single_or_batch(batch: Optional[BatchBase], fn_single: Callable, fn_batch: Callable, *args) -> Awaitable:
     if batch is None:
         return fn_single(*args)
     else:
-        return asyncio.ensure_future(fn_batch(batch, *args))
+        return fn_batch(batch, *args)
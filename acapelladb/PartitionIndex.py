@@ -1,11 +1,15 @@
 from typing import List, Optional, Dict
+from urllib.parse import quote
 
-from acapelladb import Entry
+from acapelladb.Entry import EntryView
 from acapelladb.IndexField import IndexField
-from acapelladb.utils.http import AsyncSession, raise_if_error, key_to_str
+from acapelladb.utils.assertion import check_key
+from acapelladb.utils.http import AsyncSession, raise_if_error, partition_url
 
 
 class QueryCondition(object):
+    __slots__ = ('eq', 'from_', 'to_')
+
     def __init__(self, eq: Optional[any] = None, from_: Optional[any] = None, to_: Optional[any] = None):
         self.eq = eq
         self.from_ = from_
@@ -25,16 +29,18 @@ class QueryCondition(object):
 class PartitionIndex(object):
     def __init__(self, session: AsyncSession, partition: List[str], api_prefix: str):
         assert len(partition) >= 2, "Indexed partition must be in format: [<user>, <keyspace>, ...]"
+        check_key(partition)
 
         self._session = session
         self._user = partition[0]
         self._keyspace = partition[1]
         self._partition = partition
         self._api_prefix = api_prefix
+        self._query_url = f'{partition_url(api_prefix, partition)}/index-query'
+        self._indexes_url = f'{api_prefix}/v2/users/{quote(self._user)}/keyspaces/{quote(self._keyspace)}/indexes'
 
-    async def query(self, query: Dict[str, QueryCondition], limit: Optional[int] = None) -> List[Entry]:
-        url = f'{self._api_prefix}/v2/kv/partition/{key_to_str(self._partition)}/index-query'
-        response = await self._session.get(url, json={
+    async def query(self, query: Dict[str, QueryCondition], limit: Optional[int] = None) -> List[EntryView]:
+        response = await self._session.get(self._query_url, json={
             'params': {
                'limit': limit
             },
@@ -42,18 +48,19 @@ class PartitionIndex(object):
         })
         raise_if_error(response.status)
         data = await response.json()
-        return [Entry(self._session, self._api_prefix, self._partition, e['key'], 0, e.get('value'), 3, 2, 2, None) for e in data]
+
+        view, session, api_prefix, partition = EntryView, self._session, self._api_prefix, self._partition
+        return [view(session, api_prefix, partition, e['key'], e.get('value')) for e in data]
 
     async def set_index(self, tag: int, fields: List[IndexField]):
-        url = f'{self._api_prefix}/v2/users/{self._user}/keyspaces/{self._keyspace}/indexes/{tag}'
+        url = f'{self._indexes_url}/{tag}'
         response = await self._session.put(url, json={
             'fields': [f.to_json() for f in fields]
         })
         raise_if_error(response.status)
 
     async def get_indexes(self) -> Dict[int, List[IndexField]]:
-        url = f'{self._api_prefix}/v2/users/{self._user}/keyspaces/{self._keyspace}/indexes'
-        response = await self._session.get(url)
+        response = await self._session.get(self._indexes_url)
         raise_if_error(response.status)
         data = await response.json()
         indexes = data['indexes']
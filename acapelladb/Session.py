@@ -1,8 +1,9 @@
+import asyncio
 import base64
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Tuple, AsyncIterator, Iterable
+from urllib.parse import quote
 
 from aiohttp import BasicAuth
-from requests.adapters import DEFAULT_RETRIES
 from urllib3 import Retry
 
 from acapelladb.BatchManual import BatchManual
@@ -11,28 +12,74 @@ from acapelladb.PartitionIndex import PartitionIndex
 from acapelladb.Transaction import Transaction
 from acapelladb.TransactionContext import TransactionContext
 from acapelladb.Tree import Tree
-from acapelladb.utils.assertion import check_key, check_clustering, check_limit
+from acapelladb.utils.assertion import check_key, check_clustering, check_limit, check_nrw
 from acapelladb.utils.collections import remove_none_values
-from acapelladb.utils.http import AsyncSession, raise_if_error, entry_url, key_to_str
+from acapelladb.utils.http import AsyncSession, raise_if_error, entry_url, partition_url, key_to_str, iter_json_array, \
+    DEFAULT_CONNECTION_LIMIT, DEFAULT_KEEPALIVE_TIMEOUT, DEFAULT_RETRY, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
+# максимальное количество ключей в одном батче при удалении partition'а
+DROP_BATCH_SIZE = 256
+# максимальное количество одновременно отправляемых батчей при удалении partition'а
+DROP_MAX_IN_FLIGHT = 4
 
 
 class Session(object):
     def __init__(self, host: str = '127.0.0.1', port: int = 12000,
-                 api_prefix: str = '/acapelladb'):
+                 api_prefix: str = '/acapelladb',
+                 connection_limit: int = DEFAULT_CONNECTION_LIMIT,
+                 keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+                 max_retries: Union[Retry, int] = DEFAULT_RETRY,
+                 connect_timeout: Optional[float] = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: Optional[float] = DEFAULT_READ_TIMEOUT,
+                 max_in_flight: Optional[int] = None,
+                 multi_partition_batch: bool = False):
         """
         Создание HTTP-сессии для взаимодействия с KV. 
         
         :param host: хост
         :param port: порт
+        :param api_prefix: префикс URL для запросов к API
+        :param connection_limit: максимальное количество одновременно открытых соединений
+        :param keepalive_timeout: время (в секундах), в течение которого неиспользуемое соединение остаётся открытым
+        :param max_retries: количество или политика повторов запроса при ошибках соединения и ответах 502/503/504;
+                            POST и CAS после ответа сервера не повторяются
+        :param connect_timeout: время (в секундах) на установку соединения; None - без ограничения
+        :param read_timeout: время (в секундах) ожидания очередной порции ответа; None - без ограничения
+        :param max_in_flight: максимальное количество одновременно выполняемых запросов, включая их повторы;
+                              None - ограничено только количеством соединений
+        :param multi_partition_batch: отправлять батч с несколькими partition'ами одним запросом
+                                      (/v2/kv/multi-partition-batch); включать, только если сервер это поддерживает
         """
         base_url = f'http://{host}:{port}'
-        self._session = AsyncSession(base_url=base_url)
-        self._api_prefix = api_prefix
+        self._session = AsyncSession(base_url=base_url, limit=connection_limit, keepalive_timeout=keepalive_timeout,
+                                     max_retries=max_retries, connect_timeout=connect_timeout,
+                                     read_timeout=read_timeout, max_in_flight=max_in_flight)
+        # URL запросов передаются в aiohttp уже закодированными, поэтому префикс кодируется заранее
+        self._api_prefix = quote(api_prefix)
+        self._multi_partition_batch = multi_partition_batch
 
     @property
     def api_prefix(self) -> str:
         return self._api_prefix
 
+    async def aclose(self):
+        """
+        Закрытие HTTP-сессии и всех открытых соединений.
+        Пример использования:
+
+        async with Session() as session:
+            await session.login(user, password)
+            ...
+            // при выходе из блока соединения закрываются автоматически
+        """
+        await self._session.aclose()
+
+    async def __aenter__(self) -> 'Session':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
     @staticmethod
     def _format_basic_auth(user: str, password: str) -> str:
         user_and_password = user + ':' + password
@@ -116,6 +163,24 @@ class Session(object):
         await entry.get()
         return entry
 
+    async def get_entries(self, keys: Iterable[Tuple[List[str], Optional[List[str]]]],
+                          n: int = 3, r: int = 2, w: int = 2) -> List[Entry]:
+        """
+        Получение значений по нескольким ключам вне транзакции. Запросы выполняются одновременно.
+
+        :param keys: пары из распределительного и сортируемого ключей
+        :param n: количество реплик
+        :param r: количество ответов для подтверждения чтения
+        :param w: количество ответов для подтверждения записи
+        :return: список Entry с полученными значениями, в порядке указанных ключей
+        :raise TimeoutError: когда время ожидания запроса истекло
+        :raise KvError: когда произошла неизвестная ошибка на сервере
+        """
+        check_nrw(n, r, w)
+        return list(await asyncio.gather(*[
+            self.get_entry(partition, clustering, n, r, w) for partition, clustering in keys
+        ]))
+
     async def get_version(self, partition: List[str], clustering: Optional[List[str]] = None,
                           n: int = 3, r: int = 2, w: int = 2) -> int:
         """
@@ -130,7 +195,7 @@ class Session(object):
         :raise TimeoutError: когда время ожидания запроса истекло
         :raise KvError: когда произошла неизвестная ошибка на сервере
         """
-        clustering = clustering or []
+        # entry_url сам приводит отсутствующий сортируемый ключ к пустому
         url = f'{entry_url(self._api_prefix, partition, clustering)}/version'
         response = await self._session.get(url, params={
             'n': n,
@@ -180,14 +245,68 @@ class Session(object):
         :raise TimeoutError: когда время ожидания запроса истекло
         :raise KvError: когда произошла неизвестная ошибка на сервере
         """
+        url, params = self._range_request(partition, first, last, limit, prefix, n, r, w)
+        response = await self._session.get(url, params=params)
+        raise_if_error(response.status)
+        body = await response.json()
+        # ключ и параметры уже проверены выше; общие аргументы вынесены из цикла
+        unchecked = Entry._unchecked
+        session, api_prefix = self._session, self._api_prefix
+        return [unchecked(session, api_prefix, partition, e['key'], e['version'], e.get('value'), n, r, w, None)
+                for e in body]
+
+    async def range_iter(self,
+                         partition: List[str],
+                         first: Optional[List[str]] = None,
+                         last: Optional[List[str]] = None,
+                         limit: Optional[int] = None,
+                         prefix: Optional[List[str]] = None,
+                         n: int = 3,
+                         r: int = 2,
+                         w: int = 2) -> AsyncIterator[Entry]:
+        """
+        То же, что и range, но ключи возвращаются по мере получения ответа, без загрузки всего списка в память.
+        Использование:
+
+        async for entry in session.range_iter(["some", "partition"]):
+            ...
+
+        :param partition: распределительный ключ
+        :param first: начальный ключ, не включается в ответ; по умолчанию - с первого
+        :param last: последий ключ, включается в ответ; по умолчанию - до последнего включительно
+        :param limit: максимальное количество ключей в ответе, начиная с первого; по умолчанию - нет ограничений
+        :param prefix: префикс, к которому должны принадлежать все ключи в выборке
+        :param n: количество реплик
+        :param r: количество ответов для подтверждения чтения
+        :param w: количество ответов для подтверждения записи
+        :return: асинхронный итератор по объектам Entry с данными
+        :raise TimeoutError: когда время ожидания запроса истекло
+        :raise KvError: когда произошла неизвестная ошибка на сервере
+        """
+        url, params = self._range_request(partition, first, last, limit, prefix, n, r, w)
+        response = await self._session.stream('get', url, params=params)
+        try:
+            raise_if_error(response.status)
+            # ключ и параметры уже проверены в _range_request
+            unchecked = Entry._unchecked
+            session, api_prefix = self._session, self._api_prefix
+            async for e in iter_json_array(response):
+                yield unchecked(session, api_prefix, partition, e['key'], e['version'], e.get('value'), n, r, w, None)
+        finally:
+            response.release()
+
+    def _range_request(self, partition: List[str], first: Optional[List[str]], last: Optional[List[str]],
+                       limit: Optional[int], prefix: Optional[List[str]],
+                       n: int, r: int, w: int) -> Tuple[str, dict]:
         check_key(partition)
+        check_nrw(n, r, w)
         check_clustering(first)
         check_clustering(last)
         check_limit(limit)
         check_clustering(prefix)
 
-        url = f'{self.api_prefix}/v2/kv/partition/{key_to_str(partition)}'
-        response = await self._session.get(url, params=remove_none_values({
+        url = partition_url(self._api_prefix, partition)
+        params = remove_none_values({
             'from': first and key_to_str(first),
             'to': last and key_to_str(last),
             'limit': limit,
@@ -195,10 +314,52 @@ class Session(object):
             'n': n,
             'r': r,
             'w': w,
-        }))
-        raise_if_error(response.status)
-        body = await response.json()
-        return [Entry(self._session, self._api_prefix, partition, e['key'], e['version'], e.get('value'), n, r, w, None) for e in body]
+        })
+        return url, params
+
+    async def drop_partition(self, partition: List[str], reindex: bool = False, n: int = 3, r: int = 2, w: int = 2):
+        """
+        Удаление всех ключей в указанном partition'е.
+        Ключи выбираются по мере получения ответа и удаляются батчами не больше DROP_BATCH_SIZE ключей,
+        причём одновременно отправляется не больше DROP_MAX_IN_FLIGHT батчей,
+        поэтому весь partition не загружается в память.
+        :param partition: распределительный ключ
+        :param reindex: переиндексировать удаляемые ключи?
+        :param n: количество реплик
+        :param r: количество ответов для подтверждения чтения
+        :param w: количество ответов для подтверждения записи
+        :raise TimeoutError: когда время ожидания запроса истекло
+        :raise KvError: когда произошла неизвестная ошибка на сервере
+        """
+        entries = self.range_iter(partition, n=n, r=r, w=w)
+        pending = set()
+        batch = self.batch_manual()
+        size = 0
+        try:
+            async for entry in entries:
+                batch.record_set(partition, entry.clustering, None, reindex, n, r, w)
+                size += 1
+                if size < DROP_BATCH_SIZE:
+                    continue
+                pending.add(asyncio.ensure_future(batch.send()))
+                batch = self.batch_manual()
+                size = 0
+                if len(pending) >= DROP_MAX_IN_FLIGHT:
+                    # выборка ждёт, пока не освободится место, иначе она обгоняет удаление
+                    # и все батчи оказываются в памяти одновременно
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    await asyncio.gather(*done)
+            if size > 0:
+                pending.add(asyncio.ensure_future(batch.send()))
+            await asyncio.gather(*pending)
+        except BaseException:
+            for request in pending:
+                request.cancel()
+            # дожидаемся отменённых запросов, чтобы их ошибки не остались необработанными
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise
+        finally:
+            await entries.aclose()
 
     def tree(self, tree: List[str], n: int = 3, r: int = 2, w: int = 2) -> Tree:
         """
@@ -212,7 +373,7 @@ class Session(object):
         return Tree(self._session, tree, n, r, w, self._api_prefix)
 
     def batch_manual(self) -> BatchManual:
-        return BatchManual(self._session, self._api_prefix)
+        return BatchManual(self._session, self._api_prefix, self._multi_partition_batch)
 
     def partition_index(self, partition: List[str]) -> PartitionIndex:
         return PartitionIndex(self._session, partition, self._api_prefix)
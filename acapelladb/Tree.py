@@ -4,7 +4,7 @@ from acapelladb.Cursor import Cursor
 from acapelladb.Transaction import Transaction
 from acapelladb.utils.assertion import check_key, check_nrw
 from acapelladb.utils.collections import remove_none_values
-from acapelladb.utils.http import AsyncSession, key_to_str, raise_if_error
+from acapelladb.utils.http import AsyncSession, key_to_str, raise_if_error, tree_keys_url
 
 
 class Tree(object):
@@ -17,6 +17,7 @@ class Tree(object):
         self._r = r
         self._w = w
         self._api_prefix = api_prefix
+        self._keys_url = tree_keys_url(api_prefix, name)
 
     async def get_cursor(self, key: List[str], transaction: Optional[Transaction] = None) -> Cursor:
         """
@@ -59,7 +60,7 @@ class Tree(object):
         tx_index = transaction.index if transaction is not None else None
 
         response = await self._session.get(
-            f'{self._api_prefix}/v2/dt/{key_to_str(self._name)}/keys',
+            self._keys_url,
             params=remove_none_values({
                 'from': key_to_str(first),
                 'to': key_to_str(last),
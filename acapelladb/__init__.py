@@ -1,7 +1,8 @@
 from acapelladb.Cursor import Cursor
-from acapelladb.Entry import Entry
+from acapelladb.Entry import Entry, EntryView
 from acapelladb.Session import Session
 from acapelladb.Transaction import Transaction
 from acapelladb.TransactionContext import TransactionContext
+from acapelladb.utils.loop import setup_event_loop
 
 name = "acapelladb"
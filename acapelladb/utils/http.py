@@ -1,75 +1,326 @@
 import asyncio
-from asyncio import AbstractEventLoop
-from typing import List, Optional, Iterable
+import random
+from functools import lru_cache
+from typing import List, Optional, Iterable, Union, Tuple, AsyncIterator
 from urllib.parse import quote
 
-from aiohttp import ClientSession, ClientResponse
+from aiohttp import ClientSession, ClientResponse, ClientTimeout, TCPConnector, ClientConnectorError
+from urllib3 import Retry
+from yarl import URL
 
 from acapelladb.utils.errors import CasError, TransactionNotFoundError, TransactionCompletedError, KvError, \
     AuthenticationFailedError
+from acapelladb.utils.serialization import dumps, loads, JsonArrayParser
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+DEFAULT_CONNECTION_LIMIT = 256
+DEFAULT_KEEPALIVE_TIMEOUT = 60.0
+# все запросы идут на один и тот же хост, поэтому его адрес можно долго не перезапрашивать
+DNS_CACHE_TTL = 300
+# время (в секундах) на установку соединения и на ожидание очередной порции ответа
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 30.0
+
+# размер ответа (в байтах), начиная с которого JSON разбирается по мере получения, а не целиком
+STREAM_THRESHOLD = 256 * 1024
+
+# количество закэшированных строковых представлений ключей
+KEY_CACHE_SIZE = 4096
+
+# верхняя граница задержки между повторами, если её не задаёт политика повторов
+DEFAULT_BACKOFF_MAX = 120.0
+
+# повторяются только временные ошибки шлюза и только для методов, разрешённых политикой (не POST);
+# ошибки CAS и транзакций (409, 410, 412) не повторяются
+DEFAULT_RETRY = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504))
 
 
 def key_to_str(key: Iterable[str]) -> str:
+    return _key_to_str(tuple(key))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _key_to_str(key: Tuple[str, ...]) -> str:
     return ':'.join(quote(part) for part in key)
 
 
 def entry_url(api_prefix: str, partition: List[str], clustering: Optional[List[str]] = None) -> str:
-    if clustering is None or len(clustering) == 0:
-        return f'{api_prefix}/v2/kv/keys/{key_to_str(partition)}'
-    return f'{api_prefix}/v2/kv/partition/{key_to_str(partition)}/clustering/{key_to_str(clustering)}'
+    return _entry_url(api_prefix, tuple(partition), tuple(clustering) if clustering else ())
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _entry_url(api_prefix: str, partition: Tuple[str, ...], clustering: Tuple[str, ...]) -> str:
+    if len(clustering) == 0:
+        return f'{api_prefix}/v2/kv/keys/{_key_to_str(partition)}'
+    return f'{api_prefix}/v2/kv/partition/{_key_to_str(partition)}/clustering/{_key_to_str(clustering)}'
+
+
+def partition_url(api_prefix: str, partition: List[str]) -> str:
+    return _partition_url(api_prefix, tuple(partition))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _partition_url(api_prefix: str, partition: Tuple[str, ...]) -> str:
+    return f'{api_prefix}/v2/kv/partition/{_key_to_str(partition)}'
+
+
+def tree_keys_url(api_prefix: str, tree: List[str]) -> str:
+    return _tree_keys_url(api_prefix, tuple(tree))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _tree_keys_url(api_prefix: str, tree: Tuple[str, ...]) -> str:
+    return f'{api_prefix}/v2/dt/{_key_to_str(tree)}/keys'
+
+
+def cursor_url(api_prefix: str, tree: List[str], key: List[str]) -> str:
+    return _cursor_url(api_prefix, tuple(tree), tuple(key))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _cursor_url(api_prefix: str, tree: Tuple[str, ...], key: Tuple[str, ...]) -> str:
+    return f'{_tree_keys_url(api_prefix, tree)}/{_key_to_str(key)}'
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def request_url(url: str) -> URL:
+    # все части пути (префикс API, ключи, имена пользователя и keyspace'а) кодируются при построении URL,
+    # поэтому URL не перекодируется повторно
+    return URL(url, encoded=True)
+
+
+async def iter_json_array(response: ClientResponse) -> AsyncIterator[any]:
+    """
+    Разбирает JSON-массив из тела ответа, возвращая элементы по одному.
+    Небольшой ответ читается и разбирается целиком, большой или неизвестного размера - по мере получения.
+    """
+    length = response.content_length
+    try:
+        if length is not None and length <= STREAM_THRESHOLD:
+            for item in loads(await response.read()):
+                yield item
+        else:
+            parser = JsonArrayParser()
+            async for data in response.content.iter_any():
+                for item in parser.feed(data):
+                    yield item
+            parser.close()
+    except asyncio.TimeoutError:
+        raise TimeoutError() from None
+
+
+def _decrement(count: Union[bool, int, None]) -> Optional[int]:
+    # как в urllib3: None - без ограничения, иначе счётчик оставшихся повторов
+    return None if count is None else count - 1
+
+
+def _retry_backoff_max(retry: Retry) -> float:
+    # в разных версиях urllib3 ограничение задержки называется по-разному
+    for name in ('backoff_max', 'DEFAULT_BACKOFF_MAX', 'BACKOFF_MAX'):
+        value = getattr(retry, name, None)
+        if value is not None:
+            return value
+    return DEFAULT_BACKOFF_MAX
+
+
+ERRORS = {
+    401: AuthenticationFailedError,
+    408: TimeoutError,
+    409: CasError,
+    410: TransactionNotFoundError,
+    412: TransactionCompletedError,
+}
 
 
 def raise_if_error(code: int):
     if code == 200:
         return
-    if code == 401:
-        raise AuthenticationFailedError()
-    if code == 408:
-        raise TimeoutError()
-    if code == 409:
-        raise CasError()
-    if code == 410:
-        raise TransactionNotFoundError()
-    if code == 412:
-        raise TransactionCompletedError()
+    error = ERRORS.get(code)
+    if error is not None:
+        raise error()
     raise KvError(f'Unexpected server error with code {code}')
 
 
+class Response(object):
+    """
+    Ответ сервера с полностью прочитанным телом. Соединение к этому моменту уже возвращено в пул.
+    """
+    __slots__ = ('status', 'body')
+
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.body = body
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def json(self) -> any:
+        return loads(self.body) if self.body else None
+
+
 class AsyncSession(object):
-    def __init__(self, session: ClientSession = None, loop: AbstractEventLoop = None, base_url: str = ''):
-        self._session = session or ClientSession()
-        self._loop = loop or asyncio.get_event_loop()
+    def __init__(self, session: Optional[ClientSession] = None, base_url: str = '',
+                 limit: int = DEFAULT_CONNECTION_LIMIT, keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+                 max_retries: Union[Retry, int] = DEFAULT_RETRY,
+                 connect_timeout: Optional[float] = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: Optional[float] = DEFAULT_READ_TIMEOUT,
+                 max_in_flight: Optional[int] = None):
+        # ClientSession привязывается к циклу событий, поэтому создаётся при первом запросе
+        # внутри работающего цикла, а не в конструкторе, который может вызываться синхронно
+        self._session = session
+        self._limit = limit
+        self._keepalive_timeout = keepalive_timeout
         self._base_url = base_url
         self._auth = None
+        self._retry = Retry.from_int(max_retries)
+        self._backoff_max = _retry_backoff_max(self._retry)
+        # ожидание свободного соединения в пуле не ограничивается, чтобы под нагрузкой
+        # запросы не падали по таймауту, ещё не начавшись
+        self._timeout = ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self._max_in_flight = max_in_flight
+        self._in_flight = None
 
-    async def _request(self, method, url, **kwargs):
+    def long_poll_timeout(self, wait: Optional[float]) -> ClientTimeout:
+        """
+        Таймаут для запроса, который ждёт ответа на сервере указанное время (в секундах).
+        Если время ожидания не указано, то оно определяется сервером, и время чтения не ограничивается.
+        """
+        sock_read = None
+        if wait is not None and self._timeout.sock_read is not None:
+            sock_read = wait + self._timeout.sock_read
+        return ClientTimeout(total=None, sock_connect=self._timeout.sock_connect, sock_read=sock_read)
+
+    def _client(self) -> ClientSession:
+        if self._session is None:
+            # все запросы идут на один хост, поэтому одно переиспользуемое keep-alive
+            # соединение на каждый одновременный запрос
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self._limit, keepalive_timeout=self._keepalive_timeout,
+                                       use_dns_cache=True, ttl_dns_cache=DNS_CACHE_TTL),
+                timeout=self._timeout
+            )
+        return self._session
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # как и ClientSession, семафор создаётся внутри работающего цикла событий
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+        return self._in_flight
+
+    async def _request(self, method, url, **kwargs) -> Response:
+        if self._max_in_flight is None:
+            return await self._fetch(method, url, **kwargs)
+        # слот занят вместе с повторами и паузами между ними, чтобы при перегрузке
+        # сервера повторы не добавляли к нему новых запросов
+        async with self._semaphore():
+            return await self._fetch(method, url, **kwargs)
+
+    async def _fetch(self, method, url, **kwargs) -> Response:
+        response = await self._send(method, url, **kwargs)
+        # тело читается сразу, чтобы соединение гарантированно вернулось в пул,
+        # даже если вызывающий код не читает ответ
+        try:
+            return Response(response.status, await response.read())
+        except asyncio.TimeoutError:
+            raise TimeoutError() from None
+        finally:
+            response.release()
+
+    async def _send(self, method, url, idempotent: bool = True, **kwargs) -> ClientResponse:
+        # idempotent=False запрещает повтор запроса, на который сервер уже ответил, например для CAS
         kwargs = {'auth': self._auth, **kwargs}
         kwargs = {k: v for k, v in kwargs.items() if v is not None}
-        return await self._session.request(method, self._base_url + url, **kwargs)
+        if 'json' in kwargs:
+            # тело сериализуется заранее, быстрым сериализатором вместо встроенного в aiohttp
+            kwargs['data'] = dumps(kwargs.pop('json'))
+            kwargs['headers'] = {**JSON_HEADERS, **kwargs.get('headers', {})}
+        method_name = method.upper()
+        session = self._client()
+        retry = self._retry
+        attempt = 0
+
+        while True:
+            retry_after = None
+            try:
+                response = await session.request(method, request_url(self._base_url + url), **kwargs)
+            except ClientConnectorError:
+                # соединение не установлено, значит запрос точно не дошёл до сервера и его можно повторить
+                retry = retry.new(total=_decrement(retry.total), connect=_decrement(retry.connect))
+                if retry.is_exhausted():
+                    raise
+            except asyncio.TimeoutError:
+                # запрос мог дойти до сервера, поэтому не повторяется
+                raise TimeoutError() from None
+            else:
+                # ответ получен, значит запрос мог быть выполнен; повторяются только идемпотентные запросы
+                # методов, разрешённых политикой (по умолчанию urllib3 не повторяет POST)
+                retry_after = response.headers.get('Retry-After')
+                if not idempotent or not retry.is_retry(method_name, response.status, retry_after is not None):
+                    return response
+                retry = retry.new(total=_decrement(retry.total), status=_decrement(retry.status))
+                if retry.is_exhausted():
+                    return response
+                if not retry.respect_retry_after_header:
+                    retry_after = None
+                response.release()
 
-    async def get(self, url, **kwargs) -> ClientResponse:
+            attempt += 1
+            await asyncio.sleep(self._backoff_time(attempt, retry_after))
+
+    def _backoff_time(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        # экспоненциальная задержка со случайной составляющей, чтобы повторы не шли одновременно
+        delay = min(self._retry.backoff_factor * (2 ** (attempt - 1)), self._backoff_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def get(self, url, **kwargs) -> Response:
         return await self._request('get', url, **kwargs)
 
-    async def options(self, url, **kwargs) -> ClientResponse:
+    async def options(self, url, **kwargs) -> Response:
         return await self._request('options', url, **kwargs)
 
-    async def head(self, url, **kwargs) -> ClientResponse:
+    async def head(self, url, **kwargs) -> Response:
         return await self._request('head', url, **kwargs)
 
-    async def post(self, url, data=None, json=None, **kwargs) -> ClientResponse:
+    async def post(self, url, data=None, json=None, **kwargs) -> Response:
         return await self._request('post', url, data=data, json=json, **kwargs)
 
-    async def put(self, url, data=None, **kwargs) -> ClientResponse:
+    async def put(self, url, data=None, **kwargs) -> Response:
         return await self._request('put', url, data=data, **kwargs)
 
-    async def patch(self, url, data=None, **kwargs) -> ClientResponse:
+    async def patch(self, url, data=None, **kwargs) -> Response:
         return await self._request('patch', url, data=data, **kwargs)
 
-    async def delete(self, url, **kwargs) -> ClientResponse:
+    async def delete(self, url, **kwargs) -> Response:
         return await self._request('delete', url, **kwargs)
 
+    async def stream(self, method, url, **kwargs) -> ClientResponse:
+        """
+        Выполняет запрос, не читая тело ответа. Вызывающий код должен освободить ответ через release().
+        Ограничение на количество одновременных запросов действует только до получения заголовков ответа.
+        """
+        if self._max_in_flight is None:
+            return await self._send(method, url, **kwargs)
+        async with self._semaphore():
+            return await self._send(method, url, **kwargs)
+
+    async def aclose(self):
+        """
+        Закрывает все открытые соединения. После этого сессию использовать нельзя.
+        """
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self) -> 'AsyncSession':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
     def set_cookie(self, cookies):
-        self._session.cookie_jar.update_cookies(cookies)
+        self._client().cookie_jar.update_cookies(cookies)
 
     def set_auth(self, auth):
         self._auth = auth
@@ -0,0 +1,15 @@
+import asyncio
+
+
+def setup_event_loop() -> bool:
+    """
+    Устанавливает uvloop в качестве реализации event loop'а, если он доступен.
+    Должен вызываться до создания event loop'а.
+    :return: True, если uvloop установлен
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
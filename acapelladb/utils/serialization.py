@@ -0,0 +1,185 @@
+import codecs
+import json
+import re
+from typing import Union, List, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(obj: any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data: Union[bytes, str]) -> any:
+        return orjson.loads(data)
+else:
+    # json.dumps с нестандартными параметрами создаёт новый JSONEncoder на каждый вызов
+    _encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def dumps(obj: any) -> bytes:
+        return _encoder.encode(obj).encode()
+
+    def loads(data: Union[bytes, str]) -> any:
+        return json.loads(data)
+
+
+# позиция в массиве между элементами
+_START, _FIRST_ITEM, _NEXT_ITEM, _AFTER_ITEM, _IN_ITEM, _DONE = range(6)
+
+_NON_WHITESPACE = re.compile(r'[^ \t\n\r]')
+# внутри строки важны только кавычка и экранирование, вне строки - кавычки и скобки
+_STRING_STOP = re.compile(r'["\\]')
+_CONTAINER_STOP = re.compile(r'[\[\]{}"]')
+# число или литерал заканчивается разделителем элементов массива
+_SCALAR_END = re.compile(r'[ \t\n\r,\]]')
+
+_raw_decode = json.JSONDecoder().raw_decode
+
+
+class JsonArrayParser(object):
+    """
+    Инкрементальный разбор JSON-массива: элементы возвращаются по мере поступления данных.
+    Новые данные просматриваются один раз, чтобы найти конец элемента (по глубине скобок и строкам),
+    а сам элемент разбирается целиком, когда получен полностью.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._state = _START
+        # части текущего элемента, полученные в разных порциях
+        self._parts: List[str] = []
+        self._scalar = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, data: bytes) -> List[any]:
+        """
+        Добавляет очередную порцию данных.
+        :return: элементы массива, которые удалось полностью разобрать
+        :raise ValueError: когда данные не являются JSON-массивом
+        """
+        text = self._decoder.decode(data)
+        size = len(text)
+        items = []
+        pos = 0
+
+        while pos < size:
+            if self._state == _IN_ITEM:
+                end = self._find_item_end(text, pos)
+                if end is None:
+                    self._parts.append(text[pos:])
+                    break
+                self._parts.append(text[pos:end])
+                items.append(self._finish_item())
+                pos = end
+                continue
+
+            match = _NON_WHITESPACE.search(text, pos)
+            if match is None:
+                break
+            pos = match.start()
+            char = text[pos]
+
+            if self._state == _START:
+                if char != '[':
+                    raise ValueError("Expected JSON array")
+                self._state = _FIRST_ITEM
+                pos += 1
+            elif self._state == _AFTER_ITEM:
+                if char == ',':
+                    self._state = _NEXT_ITEM
+                elif char == ']':
+                    self._state = _DONE
+                else:
+                    raise ValueError("Expected ',' or ']' after JSON array item")
+                pos += 1
+            elif self._state == _DONE:
+                raise ValueError("Unexpected data after JSON array")
+            elif char == ']' and self._state == _FIRST_ITEM:
+                self._state = _DONE
+                pos += 1
+            elif char in ',]':
+                raise ValueError("Expected JSON array item")
+            else:
+                # обычно элемент целиком помещается в порцию и сразу разбирается без просмотра
+                try:
+                    item, end = _raw_decode(text, pos)
+                except ValueError:
+                    end = None
+                if end is not None and (char in '"[{' or _SCALAR_END.match(text, end)):
+                    items.append(item)
+                    self._state = _AFTER_ITEM
+                    pos = end
+                    continue
+                # элемент не получен целиком (или содержит ошибку, о которой сообщит разбор в конце элемента)
+                self._state = _IN_ITEM
+                self._scalar = char not in '"[{'
+                self._depth = 0
+                self._in_string = False
+                self._escape = False
+
+        return items
+
+    def close(self):
+        """
+        Проверяет, что массив получен целиком и после него нет лишних данных.
+        :raise ValueError: когда массив не завершён
+        """
+        self._decoder.decode(b'', final=True)
+        if self._state != _DONE:
+            raise ValueError("Unexpected end of JSON array")
+
+    def _find_item_end(self, text: str, pos: int) -> Optional[int]:
+        """
+        Продолжает поиск конца текущего элемента с указанной позиции.
+        :return: позиция сразу после элемента или None, если элемент продолжается в следующей порции
+        """
+        if self._scalar:
+            match = _SCALAR_END.search(text, pos)
+            return None if match is None else match.start()
+
+        size = len(text)
+        if self._escape:
+            # экранированный символ пришёл в новой порции
+            self._escape = False
+            pos += 1
+
+        while True:
+            if self._in_string:
+                match = _STRING_STOP.search(text, pos)
+                if match is None:
+                    return None
+                i = match.start()
+                if text[i] == '\\':
+                    if i + 1 == size:
+                        self._escape = True
+                        return None
+                    pos = i + 2
+                    continue
+                self._in_string = False
+            else:
+                match = _CONTAINER_STOP.search(text, pos)
+                if match is None:
+                    return None
+                i = match.start()
+                char = text[i]
+                if char == '"':
+                    self._in_string = True
+                elif char in '[{':
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+            pos = i + 1
+            if self._depth == 0 and not self._in_string:
+                return pos
+
+    def _finish_item(self) -> any:
+        text = ''.join(self._parts)
+        self._parts.clear()
+        self._state = _AFTER_ITEM
+        # элемент получен целиком, поэтому ошибка разбора - это ошибка в данных, а не нехватка данных
+        return loads(text)
@@ -1,17 +1,20 @@
 import asyncio
 from datetime import datetime
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict, Callable
 from uuid import UUID, uuid4
 
-from acapelladb import Session
+from acapelladb import Session, setup_event_loop
 from acapelladb.IndexField import IndexField, IndexFieldType, IndexFieldOrder
 from acapelladb.PartitionIndex import QueryCondition
 from examples.credentials import USER_NAME, PASSWORD
 
 
 class Person:
-    def __init__(self, id: UUID, first_name: str, last_name: str):
+    __slots__ = ('id', 'id_str', 'first_name', 'last_name')
+
+    def __init__(self, id: UUID, first_name: str, last_name: str, id_str: Optional[str] = None):
         self.id = id
+        self.id_str = id_str or str(id)
         self.first_name = first_name
         self.last_name = last_name
 
@@ -20,19 +23,40 @@ class Person:
 
 
 class Apartment:
-    def __init__(self, id: UUID, address: str):
+    __slots__ = ('id', 'id_str', 'address')
+
+    def __init__(self, id: UUID, address: str, id_str: Optional[str] = None):
         self.id = id
+        self.id_str = id_str or str(id)
         self.address = address
 
     def __repr__(self):
         return f'Apartment(id={self.id}, address={self.address})'
 
 
+def to_timestamp_us(value: datetime) -> int:
+    return round(value.timestamp() * 1_000_000)
+
+
 class Registration:
-    def __init__(self, person_id: UUID, apartment_id: UUID, created_at: datetime):
+    __slots__ = ('person_id', 'apartment_id', 'person_id_str', 'apartment_id_str', 'created_at_us', '_created_at')
+
+    def __init__(self, person_id: UUID, apartment_id: UUID, created_at: Optional[datetime] = None,
+                 person_id_str: Optional[str] = None, apartment_id_str: Optional[str] = None,
+                 created_at_us: Optional[int] = None):
         self.person_id = person_id
         self.apartment_id = apartment_id
-        self.created_at = created_at
+        self.person_id_str = person_id_str or str(person_id)
+        self.apartment_id_str = apartment_id_str or str(apartment_id)
+        # на сервере время хранится в микросекундах, datetime создаётся только при обращении
+        self.created_at_us = created_at_us if created_at_us is not None else to_timestamp_us(created_at)
+        self._created_at = created_at
+
+    @property
+    def created_at(self) -> datetime:
+        if self._created_at is None:
+            self._created_at = datetime.fromtimestamp(self.created_at_us / 1_000_000)
+        return self._created_at
 
     def __repr__(self):
         return f'Registration(' \
@@ -42,20 +66,32 @@ class Registration:
                f')'
 
 
+def compile_value_serializer(fields: Dict[str, str]) -> Callable[[object], dict]:
+    # builds a function specialized to the given fields (value field name -> object attribute),
+    # e.g. {'name': 'name'} gives `def serialize(obj): return {'name': obj.name}`
+    for attr in fields.values():
+        assert attr.isidentifier(), f"Invalid attribute name: {attr}"
+    items = ', '.join(f'{name!r}: obj.{attr}' for name, attr in fields.items())
+    namespace = {}
+    exec(f'def serialize(obj):\n    return {{{items}}}\n', namespace)
+    return namespace['serialize']
+
+
 class Persons:
     # first key part is user-id
     # second key part is keyspace
-    PARTITION = [USER_NAME, 'persons']
+    PARTITION = (USER_NAME, 'persons')
+
+    _serialize_value = staticmethod(compile_value_serializer({
+        'first_name': 'first_name',
+        'last_name': 'last_name',
+    }))
 
     def __init__(self, session: Session):
         self._session = session
 
     async def drop_table(self):
-        result = await self._session.range(self.PARTITION)
-        batch = self._session.batch_manual()
-        for entry in result:
-            entry.set(None, reindex=True, batch=batch)
-        await batch.send()
+        await self._session.drop_partition(self.PARTITION, reindex=True)
 
     async def create_table(self):
         # indexes are assigned to keyspace, which is computed out of partition like this:
@@ -75,6 +111,9 @@ class Persons:
         entry = await self._session.get_entry(self.PARTITION, key)
         return self._deserialize(key, entry.value) if entry.value else None
 
+    async def get_many(self, ids: List[UUID]) -> List[Optional[Person]]:
+        return await asyncio.gather(*(self.get(id) for id in ids))
+
     async def get_by_first_name(self, first_name: str) -> List[Person]:
         result = await self._session.partition_index(self.PARTITION).query({
             'first_name': QueryCondition(eq=first_name)
@@ -93,34 +132,30 @@ class Persons:
 
     @classmethod
     def _serialize(cls, person: Person) -> Tuple[List[str], dict]:
-        key = cls._serialize_key(person.id)
-        value = {
-            'first_name': person.first_name,
-            'last_name': person.last_name
-        }
-        return key, value
+        return [person.id_str], cls._serialize_value(person)
 
     @staticmethod
     def _deserialize(key: List[str], value: dict) -> Person:
         return Person(
             id=UUID(key[0]),
             first_name=value['first_name'],
-            last_name=value['last_name']
+            last_name=value['last_name'],
+            id_str=key[0]
         )
 
 
 class Apartments:
-    PARTITION = [USER_NAME, 'apartments']
+    PARTITION = (USER_NAME, 'apartments')
+
+    _serialize_value = staticmethod(compile_value_serializer({
+        'address': 'address',
+    }))
 
     def __init__(self, session: Session):
         self._session = session
 
     async def drop_table(self):
-        result = await self._session.range(self.PARTITION)
-        batch = self._session.batch_manual()
-        for entry in result:
-            entry.set(None, reindex=True, batch=batch)
-        await batch.send()
+        await self._session.drop_partition(self.PARTITION, reindex=True)
 
     async def create_table(self):
         pass
@@ -135,38 +170,40 @@ class Apartments:
         entry = await self._session.get_entry(self.PARTITION, key)
         return self._deserialize(key, entry.value) if entry.value else None
 
+    async def get_many(self, ids: List[UUID]) -> List[Optional[Apartment]]:
+        return await asyncio.gather(*(self.get(id) for id in ids))
+
     @classmethod
     def _serialize_key(cls, id: UUID) -> List[str]:
         return [str(id)]
 
     @classmethod
     def _serialize(cls, apartment: Apartment) -> Tuple[List[str], dict]:
-        key = cls._serialize_key(apartment.id)
-        value = {
-            'address': apartment.address
-        }
-        return key, value
+        return [apartment.id_str], cls._serialize_value(apartment)
 
     @staticmethod
     def _deserialize(key: List[str], value: dict) -> Apartment:
         return Apartment(
             id=UUID(key[0]),
-            address=value['address']
+            address=value['address'],
+            id_str=key[0]
         )
 
 
 class Registrations:
-    PARTITION = [USER_NAME, 'registrations']
+    PARTITION = (USER_NAME, 'registrations')
+
+    _serialize_value = staticmethod(compile_value_serializer({
+        'person_id': 'person_id_str',
+        'apartment_id': 'apartment_id_str',
+        'created_at': 'created_at_us',
+    }))
 
     def __init__(self, session: Session):
         self._session = session
 
     async def drop_table(self):
-        result = await self._session.range(self.PARTITION)
-        batch = self._session.batch_manual()
-        for entry in result:
-            entry.set(None, reindex=True, batch=batch)
-        await batch.send()
+        await self._session.drop_partition(self.PARTITION, reindex=True)
 
     async def create_table(self):
         indexes = self._session.partition_index(self.PARTITION)
@@ -198,7 +235,7 @@ class Registrations:
 
     async def get_since(self, since: datetime) -> List[Registration]:
         result = await self._session.partition_index(self.PARTITION).query({
-            'created_at': QueryCondition(from_=since.timestamp())
+            'created_at': QueryCondition(from_=to_timestamp_us(since))
         })
         return [self._deserialize(entry.clustering, entry.value) for entry in result]
 
@@ -208,20 +245,16 @@ class Registrations:
 
     @classmethod
     def _serialize(cls, registration: Registration) -> Tuple[List[str], dict]:
-        key = cls._serialize_key(registration.person_id, registration.apartment_id)
-        value = {
-            'person_id': str(registration.person_id),
-            'apartment_id': str(registration.apartment_id),
-            'created_at': registration.created_at.timestamp()
-        }
-        return key, value
+        return [registration.person_id_str, registration.apartment_id_str], cls._serialize_value(registration)
 
     @staticmethod
     def _deserialize(key: List[str], value: dict) -> Registration:
         return Registration(
             person_id=UUID(key[0]),
             apartment_id=UUID(key[1]),
-            created_at=datetime.fromtimestamp(value['created_at'])
+            person_id_str=key[0],
+            apartment_id_str=key[1],
+            created_at_us=value['created_at']
         )
 
 
@@ -309,13 +342,13 @@ async def run():
 
     # query registrations for apartment1
     result = await registrations.get_by_apartment(apartment1.id)
-    result = [await persons.get(entry.person_id) for entry in result]
+    result = await persons.get_many([entry.person_id for entry in result])
     # prints John Smith, Mary Smith
     print(result)
 
     # query registrations for person4
     result = await registrations.get_by_person(person4.id)
-    result = [await apartments.get(entry.apartment_id) for entry in result]
+    result = await apartments.get_many([entry.apartment_id for entry in result])
     # prints
     # 70 Bowman St. South Windsor, CT 06074
     # 514 S. Magnolia St. Orlando, FL 32806
@@ -326,6 +359,10 @@ async def run():
     # prints registrations 3, 4 and 5
     print(result)
 
+    # close connections
+    await session.aclose()
+
 
 if __name__ == '__main__':
+    setup_event_loop()
     asyncio.get_event_loop().run_until_complete(run())
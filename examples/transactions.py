@@ -1,15 +1,23 @@
 import asyncio
 from decimal import Decimal
+from functools import lru_cache
 from typing import Optional, List, Tuple
 from uuid import UUID, uuid1, uuid4
 
-from acapelladb import Session, Transaction
+from acapelladb import Session, setup_event_loop, Transaction
 from examples.credentials import USER_NAME, PASSWORD
 
 
+# transfers usually reference a small set of accounts, so parsed ids are reused
+UUID_CACHE_SIZE = 8192
+
+parse_uuid = lru_cache(maxsize=UUID_CACHE_SIZE)(UUID)
+
+
 class Account:
-    def __init__(self, id: UUID, balance: Decimal):
+    def __init__(self, id: UUID, balance: Decimal, id_str: Optional[str] = None):
         self.id = id
+        self.id_str = id_str or str(id)
         self.balance = balance
 
     def __repr__(self):
@@ -17,28 +25,30 @@ class Account:
 
 
 class Transfer:
-    def __init__(self, timestamp: UUID, id_from: UUID, id_to: UUID, amount: Decimal):
+    def __init__(self, timestamp: UUID, id_from: UUID, id_to: UUID, amount: Decimal,
+                 timestamp_str: Optional[str] = None, id_from_str: Optional[str] = None,
+                 id_to_str: Optional[str] = None):
         self.timestamp = timestamp
         self.id_from = id_from
         self.id_to = id_to
         self.amount = amount
+        # string forms are used in keys and values, so they are computed once
+        self.timestamp_str = timestamp_str or str(timestamp)
+        self.id_from_str = id_from_str or str(id_from)
+        self.id_to_str = id_to_str or str(id_to)
 
     def __repr__(self):
         return f'Transfer(timestamp={self.timestamp}, id_from={self.id_from}, id_to={self.id_to}, amount={self.amount})'
 
 
 class Accounts:
-    PARTITION = [USER_NAME, 'accounts']
+    PARTITION = (USER_NAME, 'accounts')
 
     def __init__(self, session: Session):
         self._session = session
 
     async def drop_table(self):
-        result = await self._session.range(self.PARTITION)
-        batch = self._session.batch_manual()
-        for entry in result:
-            entry.set(None, reindex=True, batch=batch)
-        await batch.send()
+        await self._session.drop_partition(self.PARTITION, reindex=True)
 
     async def create_table(self):
         pass
@@ -59,7 +69,7 @@ class Accounts:
 
     @classmethod
     def _serialize(cls, account: Account) -> Tuple[List[str], dict]:
-        key = cls._serialize_key(account.id)
+        key = [account.id_str]
         value = {
             'balance': str(account.balance)
         }
@@ -68,23 +78,20 @@ class Accounts:
     @staticmethod
     def _deserialize(key: List[str], value: dict) -> Account:
         return Account(
-            id=UUID(key[0]),
+            id=parse_uuid(key[0]),
+            id_str=key[0],
             balance=Decimal(value['balance'])
         )
 
 
 class Transfers:
-    PARTITION = [USER_NAME, 'transfers']
+    PARTITION = (USER_NAME, 'transfers')
 
     def __init__(self, session: Session):
         self._session = session
 
     async def drop_table(self):
-        result = await self._session.range(self.PARTITION)
-        batch = self._session.batch_manual()
-        for entry in result:
-            entry.set(None, reindex=True, batch=batch)
-        await batch.send()
+        await self._session.drop_partition(self.PARTITION, reindex=True)
 
     async def create_table(self):
         pass
@@ -100,8 +107,8 @@ class Transfers:
         return self._deserialize(key, entry.value) if entry.value else None
 
     async def get_all(self) -> List[Transfer]:
-        result = await self._session.range(self.PARTITION)
-        return [self._deserialize(e.clustering, e.value) for e in result if e.value is not None]
+        return [self._deserialize(e.clustering, e.value)
+                async for e in self._session.range_iter(self.PARTITION) if e.value is not None]
 
     @classmethod
     def _serialize_key(cls, timestamp: UUID) -> List[str]:
@@ -109,10 +116,10 @@ class Transfers:
 
     @classmethod
     def _serialize(cls, transfer: Transfer) -> Tuple[List[str], dict]:
-        key = cls._serialize_key(transfer.timestamp)
+        key = [transfer.timestamp_str]
         value = {
-            'id_from': str(transfer.id_from),
-            'id_to': str(transfer.id_to),
+            'id_from': transfer.id_from_str,
+            'id_to': transfer.id_to_str,
             'amount': str(transfer.amount)
         }
         return key, value
@@ -121,9 +128,12 @@ class Transfers:
     def _deserialize(key: List[str], value: dict) -> Transfer:
         return Transfer(
             timestamp=UUID(key[0]),
-            id_from=UUID(value['id_from']),
-            id_to=UUID(value['id_to']),
-            amount=Decimal(value['amount'])
+            id_from=parse_uuid(value['id_from']),
+            id_to=parse_uuid(value['id_to']),
+            amount=Decimal(value['amount']),
+            timestamp_str=key[0],
+            id_from_str=value['id_from'],
+            id_to_str=value['id_to']
         )
 
 
@@ -134,12 +144,17 @@ class Model:
         self.transfers = Transfers(session)
 
     async def drop_all(self):
-        await self.accounts.drop_table()
-        await self.transfers.drop_table()
+        # tables are stored in different partitions, so they are dropped concurrently
+        await asyncio.gather(
+            self.accounts.drop_table(),
+            self.transfers.drop_table(),
+        )
 
     async def create_all(self):
-        await self.accounts.create_table()
-        await self.transfers.create_table()
+        await asyncio.gather(
+            self.accounts.create_table(),
+            self.transfers.create_table(),
+        )
 
 
 class Transactor:
@@ -147,20 +162,29 @@ class Transactor:
         self._model = model
 
     async def transaction(self, id_from: UUID, id_to: UUID, amount: Decimal):
+        # both accounts are read and written independently, so they must be different keys
+        assert id_from != id_to, "Source and destination accounts must be different"
+
         async with self._model.session.transaction() as tx:
             timestamp = uuid1()
 
-            from_account = await self._model.accounts.get(tx, id_from)
+            # reads of both accounts are independent
+            from_account, to_account = await asyncio.gather(
+                self._model.accounts.get(tx, id_from),
+                self._model.accounts.get(tx, id_to),
+            )
             assert from_account.balance >= amount, "Source account must have required amount to transfer"
             from_account.balance -= amount
-            await self._model.accounts.save(tx, from_account)
-
-            to_account = await self._model.accounts.get(tx, id_to)
             to_account.balance += amount
-            await self._model.accounts.save(tx, to_account)
 
-            transfer = Transfer(timestamp, id_from, id_to, amount)
-            await self._model.transfers.save(tx, transfer)
+            # as well as all writes
+            transfer = Transfer(timestamp, id_from, id_to, amount,
+                                id_from_str=from_account.id_str, id_to_str=to_account.id_str)
+            await asyncio.gather(
+                self._model.accounts.save(tx, from_account),
+                self._model.accounts.save(tx, to_account),
+                self._model.transfers.save(tx, transfer),
+            )
 
 
 async def run():
@@ -203,6 +227,10 @@ async def run():
         print('account 2', await model.accounts.get(tx, account2.id))
         print('transfers', await model.transfers.get_all())
 
+    # close connections
+    await session.aclose()
+
 
 if __name__ == '__main__':
+    setup_event_loop()
     asyncio.get_event_loop().run_until_complete(run())
@@ -24,4 +24,8 @@ setup(
         'aiohttp == 3.4.4',
         'requests == 2.20.0',
     ],
+    extras_require={
+        'fast': ['orjson', 'uvloop'],
+        'test': ['pytest', 'pytest-asyncio >= 0.26'],
+    },
 )
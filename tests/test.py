@@ -1,98 +1,162 @@
 import asyncio
+import os
 import random
-import uuid
-from unittest import TestCase, main
+from collections import deque
 
+import pytest
 import requests
+from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
-from acapelladb import Session
+from acapelladb import Session, setup_event_loop
+from acapelladb.Session import DROP_BATCH_SIZE
 from acapelladb.IndexField import IndexField, IndexFieldType, IndexFieldOrder
 from acapelladb.PartitionIndex import QueryCondition
-from acapelladb.utils.errors import CasError
+from acapelladb.utils.errors import CasError, AuthenticationFailedError
+from acapelladb.utils.serialization import JsonArrayParser
 
 USER = 'user'
 PASSWORD = 'password'
 
-session = Session(port=5678)
+setup_event_loop()
 
-requests.post('http://localhost:5678/auth/signup', json={
-    'username': USER,
-    'password': PASSWORD,
-    'email': 'test@test.ru'
-})
+# одна политика повторов для синхронной и асинхронной сессий
+retry = Retry(total=3, backoff_factor=0.1, status_forcelist=(502, 503, 504))
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(session.login(USER, PASSWORD))
+# синхронные запросы к AppServer идут через одну сессию с пулом соединений и повторами
+sync_session = requests.Session()
+sync_session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=retry))
 
 
-def async_test(f):
-    def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
-        loop.run_until_complete(future)
-    return wrapper
+def signup():
+    sync_session.post('http://localhost:5678/auth/signup', json={
+        'username': USER,
+        'password': PASSWORD,
+        'email': 'test@test.ru'
+    })
+
+
+@pytest.fixture(scope='session')
+async def session():
+    session = Session(port=5678, connection_limit=64, max_retries=retry)
+    # пользователь создаётся только на чистой базе
+    try:
+        await session.login(USER, PASSWORD)
+    except AuthenticationFailedError:
+        signup()
+        await session.login(USER, PASSWORD)
+    yield session
+    await session.aclose()
+
+
+# тестам нужна только уникальность ключей, поэтому случайные строки генерируются заранее
+TOKEN_POOL_SIZE = 4096
+token_pool = deque(os.urandom(16).hex() for _ in range(TOKEN_POOL_SIZE))
+randint = random.randint
+
+
+def random_token():
+    return token_pool.popleft() if token_pool else os.urandom(16).hex()
 
 
 def random_tree():
-    c = random.randint(1, 3)
-    return [USER] + [str(uuid.uuid4()) for _ in range(c)]
+    return [USER, *[random_token() for _ in range(randint(1, 3))]]
 
 
 def random_partition():
-    c = random.randint(1, 3)
-    return [USER] + [str(uuid.uuid4()) for _ in range(c)]
+    return [USER, *[random_token() for _ in range(randint(1, 3))]]
 
 
 def random_clustering():
-    c = random.randint(1, 3)
-    return [str(uuid.uuid4()) for _ in range(c)]
+    return [random_token() for _ in range(randint(1, 3))]
 
 
 def random_value():
-    return str(uuid.uuid4())
+    return random_token()
+
+
+async def fill_tree(tree):
+    # в DT нет батчей, поэтому независимые записи отправляются одновременно
+    await asyncio.gather(
+        tree.cursor(['A', 'A']).set('foo'),
+        tree.cursor(['A', 'B']).set('bar'),
+        tree.cursor(['B', 'A']).set('baz'),
+    )
+
+
+def parse_by_chunks(data: bytes, size: int) -> list:
+    parser = JsonArrayParser()
+    items = []
+    for i in range(0, len(data), size):
+        items.extend(parser.feed(data[i:i + size]))
+    parser.close()
+    return items
+
+
+class TestJsonArrayParser:
+    # граница порции попадает на каждую позицию: внутрь чисел, строк, экранирования, литералов,
+    # вложенных структур и многобайтовых символов
+    def test_chunk_boundaries(self):
+        data = '[1.5, 1e5, -12.5e-3, 10, true, false, null, "a\\"b\\\\", "жж", {"x": [1, "]}"]}, []]'.encode()
+        for size in range(1, len(data) + 1):
+            assert parse_by_chunks(data, size) == [1.5, 1e5, -12.5e-3, 10, True, False, None, 'a"b\\', 'жж',
+                                                   {'x': [1, ']}']}, []]
+
+    def test_empty(self):
+        assert parse_by_chunks(b' [ ] ', 1) == []
+
+    def test_large_item(self):
+        value = 'x' * 1000000
+        assert parse_by_chunks(f'["{value}", 1]'.encode(), 4096) == [value, 1]
+
+    def test_invalid(self):
+        for data in [b'[,,1,,]', b'[{"a":1}{"b":2}]', b'[1,]', b'[,1]', b'[1 2]', b'[1.x]', b'[1', b'{}',
+                     b'[nul, 1]', b'[1] trailing', b'[1]]']:
+            for size in (1, 3, len(data)):
+                with pytest.raises(ValueError):
+                    parse_by_chunks(data, size)
+
+    def test_invalid_item_reported_before_end(self):
+        parser = JsonArrayParser()
+        with pytest.raises(ValueError):
+            parser.feed(b'[nul, ')
 
 
 # Для тестов необходимы запущенные KV (127.0.0.1:10000), HTTP (127.0.0.1:12000) и AppServer (127.0.0.1:5678) ноды
 
 
-class TestKvNonTx(TestCase):
-    @async_test
-    async def test_get(self):
+class TestKvNonTx:
+    async def test_get(self, session):
         await session.get_entry(random_partition())
 
-    @async_test
-    async def test_set(self):
+    async def test_set(self, session):
         await session.entry(random_partition()).set(random_value())
 
-    @async_test
-    async def test_set_none(self):
+    async def test_set_none(self, session):
         await session.entry(random_partition()).set(None)
 
-    @async_test
-    async def test_return_set_value(self):
+    async def test_return_set_value(self, session):
         key = random_partition()
         value = random_value()
-        await session.entry(key).set(value)
-        assert (await session.get_entry(key)).value == value
+        entry = session.entry(key)
+        await entry.set(value)
+        assert await entry.get() == value
 
-    @async_test
-    async def test_cas_success(self):
+    async def test_cas_success(self, session):
         key = random_partition()
         value = random_value()
-        await session.entry(key).cas(value)
-        assert (await session.get_entry(key)).value == value
+        entry = session.entry(key)
+        await entry.cas(value)
+        assert await entry.get() == value
 
-    @async_test
-    async def test_cas_failed(self):
+    async def test_cas_failed(self, session):
         key = random_partition()
         value = random_value()
         entry = await session.get_entry(key)
-        with self.assertRaises(CasError):
+        with pytest.raises(CasError):
             await entry.cas(value, entry.version + 1)
 
-    @async_test
-    async def test_get_version_returns_valid_version(self):
+    async def test_get_version_returns_valid_version(self, session):
         key = random_partition()
         value = random_value()
         entry = session.entry(key)
@@ -101,46 +165,41 @@ class TestKvNonTx(TestCase):
         assert entry.version == version
 
 
-class TestKvClustering(TestCase):
-    @async_test
-    async def test_get(self):
+class TestKvClustering:
+    async def test_get(self, session):
         await session.get_entry(random_partition(), random_clustering())
 
-    @async_test
-    async def test_set(self):
+    async def test_set(self, session):
         await session.entry(random_partition(), random_clustering()).set(random_value())
 
-    @async_test
-    async def test_set_none(self):
+    async def test_set_none(self, session):
         await session.entry(random_partition(), random_clustering()).set(None)
 
-    @async_test
-    async def test_return_set_value(self):
+    async def test_return_set_value(self, session):
         partition = random_partition()
         clustering = random_clustering()
         value = random_value()
-        await session.entry(partition, clustering).set(value)
-        assert (await session.get_entry(partition, clustering)).value == value
+        entry = session.entry(partition, clustering)
+        await entry.set(value)
+        assert await entry.get() == value
 
-    @async_test
-    async def test_cas_success(self):
+    async def test_cas_success(self, session):
         partition = random_partition()
         clustering = random_clustering()
         value = random_value()
-        await session.entry(partition, clustering).cas(value)
-        assert (await session.get_entry(partition, clustering)).value == value
+        entry = session.entry(partition, clustering)
+        await entry.cas(value)
+        assert await entry.get() == value
 
-    @async_test
-    async def test_cas_failed(self):
+    async def test_cas_failed(self, session):
         partition = random_partition()
         clustering = random_clustering()
         value = random_value()
         entry = await session.get_entry(partition, clustering)
-        with self.assertRaises(CasError):
+        with pytest.raises(CasError):
             await entry.cas(value, entry.version + 1)
 
-    @async_test
-    async def test_get_version_returns_valid_version(self):
+    async def test_get_version_returns_valid_version(self, session):
         partition = random_partition()
         clustering = random_clustering()
         value = random_value()
@@ -149,63 +208,83 @@ class TestKvClustering(TestCase):
         version = await session.get_version(partition, clustering)
         assert entry.version == version
 
-    @async_test
-    async def test_range(self):
+    async def test_range(self, session):
         partition = random_partition()
         a = ['aaa', 'aaa']
         b = ['bbb']
         c = ['ccc']
 
-        await session.entry(partition, a).set('foo')
-        await session.entry(partition, b).set('bar')
-        await session.entry(partition, c).set('baz')
-
-        result = await session.range(partition)
-        assert [a, b, c] == [e.clustering for e in result]
-
-        result = await session.range(partition, first=a)
-        assert [b, c] == [e.clustering for e in result]
-
-        result = await session.range(partition, last=b)
-        assert [a, b] == [e.clustering for e in result]
-
-        result = await session.range(partition, limit=2)
-        assert [a, b] == [e.clustering for e in result]
+        batch = session.batch_manual()
+        session.entry(partition, a).set('foo', batch=batch)
+        session.entry(partition, b).set('bar', batch=batch)
+        session.entry(partition, c).set('baz', batch=batch)
+        await batch.send()
 
-    @async_test
-    async def test_prefix(self):
+        all_keys, after_first, before_last, limited = await asyncio.gather(
+            session.range(partition),
+            session.range(partition, first=a),
+            session.range(partition, last=b),
+            session.range(partition, limit=2),
+        )
+        assert [a, b, c] == [e.clustering for e in all_keys]
+        assert [b, c] == [e.clustering for e in after_first]
+        assert [a, b] == [e.clustering for e in before_last]
+        assert [a, b] == [e.clustering for e in limited]
+
+    async def test_prefix(self, session):
         partition = random_partition()
         a = ['aaa', 'aaa', 'aaa']
         b = ['aaa', 'bbb', 'bbb']
         c = ['ccc', 'ccc']
 
-        await session.entry(partition, a).set('foo')
-        await session.entry(partition, b).set('bar')
-        await session.entry(partition, c).set('baz')
+        batch = session.batch_manual()
+        session.entry(partition, a).set('foo', batch=batch)
+        session.entry(partition, b).set('bar', batch=batch)
+        session.entry(partition, c).set('baz', batch=batch)
+        await batch.send()
 
-        result = await session.range(partition, prefix=['aaa'])
-        assert [a, b] == [e.clustering for e in result]
+        short_prefix, long_prefix, other_prefix = await asyncio.gather(
+            session.range(partition, prefix=['aaa']),
+            session.range(partition, prefix=['aaa', 'aaa']),
+            session.range(partition, prefix=['ccc']),
+        )
+        assert [a, b] == [e.clustering for e in short_prefix]
+        assert [a] == [e.clustering for e in long_prefix]
+        assert [c] == [e.clustering for e in other_prefix]
 
-        result = await session.range(partition, prefix=['aaa', 'aaa'])
-        assert [a] == [e.clustering for e in result]
+    async def test_drop_partition(self, session):
+        partition = random_partition()
+
+        batch = session.batch_manual()
+        session.entry(partition, ['aaa']).set('foo', batch=batch)
+        session.entry(partition, ['bbb']).set('bar', batch=batch)
+        await batch.send()
 
-        result = await session.range(partition, prefix=['ccc'])
-        assert [c] == [e.clustering for e in result]
+        await session.drop_partition(partition)
+        assert [] == await session.range(partition)
 
+    async def test_drop_partition_in_several_batches(self, session):
+        partition = random_partition()
+
+        batch = session.batch_manual()
+        for i in range(DROP_BATCH_SIZE + 1):
+            session.entry(partition, [f'{i:04}']).set(i, batch=batch)
+        await batch.send()
 
-class TestKvTx(TestCase):
-    @async_test
-    async def test_create_tx(self):
+        await session.drop_partition(partition, reindex=True)
+        assert [] == await session.range(partition)
+
+
+class TestKvTx:
+    async def test_create_tx(self, session):
         async with session.transaction():
             pass
 
-    @async_test
-    async def test_tx_rollback(self):
+    async def test_tx_rollback(self, session):
         async with session.transaction() as tx:
             await tx.rollback()
 
-    @async_test
-    async def test_old_value_if_rollback(self):
+    async def test_old_value_if_rollback(self, session):
         key = random_partition()
         async with session.transaction() as tx:
             e = await tx.get_entry(key)
@@ -217,8 +296,7 @@ class TestKvTx(TestCase):
             e = await tx.get_entry(key)
             assert value == e.value
 
-    @async_test
-    async def test_rollback_if_error(self):
+    async def test_rollback_if_error(self, session):
         key = random_partition()
         value = None
         try:
@@ -234,8 +312,7 @@ class TestKvTx(TestCase):
             e = await tx.get_entry(key)
             assert value == e.value
 
-    @async_test
-    async def test_see_set_in_other_tx(self):
+    async def test_see_set_in_other_tx(self, session):
         key = random_partition()
         value = random_value()
 
@@ -247,29 +324,23 @@ class TestKvTx(TestCase):
             assert value == e.value
 
 
-class TestDtNonTx(TestCase):
-    @async_test
-    async def test_get(self):
+class TestDtNonTx:
+    async def test_get(self, session):
         await session.tree(random_tree()).get_cursor(random_clustering())
 
-    @async_test
-    async def test_set(self):
+    async def test_set(self, session):
         await session.tree(random_tree()).cursor(random_clustering()).set(random_value())
 
-    @async_test
-    async def test_return_set_value(self):
+    async def test_return_set_value(self, session):
         tree = session.tree(random_tree())
         key = random_clustering()
         value = random_value()
         await tree.cursor(key).set(value)
         assert value == (await tree.get_cursor(key)).value
 
-    @async_test
-    async def test_next(self):
+    async def test_next(self, session):
         tree = session.tree(random_tree())
-        await tree.cursor(['A', 'A']).set('foo')
-        await tree.cursor(['A', 'B']).set('bar')
-        await tree.cursor(['B', 'A']).set('baz')
+        await fill_tree(tree)
 
         c = await tree.get_cursor(['A', 'A'])
 
@@ -284,12 +355,9 @@ class TestDtNonTx(TestCase):
         c = await c.next()
         assert c is None
 
-    @async_test
-    async def test_prev(self):
+    async def test_prev(self, session):
         tree = session.tree(random_tree())
-        await tree.cursor(['A', 'A']).set('foo')
-        await tree.cursor(['A', 'B']).set('bar')
-        await tree.cursor(['B', 'A']).set('baz')
+        await fill_tree(tree)
 
         c = await tree.get_cursor(['B', 'A'])
 
@@ -305,42 +373,46 @@ class TestDtNonTx(TestCase):
         assert c is None
 
 
-class TestDtTx(TestCase):
-    @async_test
-    async def test_see_set_in_other_tx(self):
+class TestDtTx:
+    async def test_see_set_in_other_tx(self, session):
         tree = session.tree(random_tree())
 
         async with session.transaction() as tx:
-            await tree.cursor(['A'], tx).set('foo')
-            await tree.cursor(['B'], tx).set('bar')
+            await asyncio.gather(
+                tree.cursor(['A'], tx).set('foo'),
+                tree.cursor(['B'], tx).set('bar'),
+            )
 
         async with session.transaction() as tx:
-            assert (await tree.get_cursor(['A'], tx)).value == 'foo'
-            assert (await tree.get_cursor(['B'], tx)).value == 'bar'
+            a, b = await asyncio.gather(tree.get_cursor(['A'], tx), tree.get_cursor(['B'], tx))
+            assert a.value == 'foo'
+            assert b.value == 'bar'
 
-    @async_test
-    async def test_old_value_if_rollback(self):
+    async def test_old_value_if_rollback(self, session):
         tree = session.tree(random_tree())
 
         async with session.transaction() as tx:
-            await tree.cursor(['A'], tx).set('foo')
-            await tree.cursor(['B'], tx).set('bar')
+            await asyncio.gather(
+                tree.cursor(['A'], tx).set('foo'),
+                tree.cursor(['B'], tx).set('bar'),
+            )
             await tx.rollback()
 
         async with session.transaction() as tx:
-            assert (await tree.get_cursor(['A'], tx)).value is None
-            assert (await tree.get_cursor(['B'], tx)).value is None
+            a, b = await asyncio.gather(tree.get_cursor(['A'], tx), tree.get_cursor(['B'], tx))
+            assert a.value is None
+            assert b.value is None
 
 
-class TestDtRange(TestCase):
-    @async_test
-    async def test_range_all_keys(self):
+class TestDtRange:
+    # тесты только читают дерево, поэтому оно заполняется один раз на весь класс
+    @pytest.fixture(scope='class')
+    async def tree(self, session):
         tree = session.tree(random_tree())
+        await fill_tree(tree)
+        return tree
 
-        await tree.cursor(['A', 'A']).set('foo')
-        await tree.cursor(['A', 'B']).set('bar')
-        await tree.cursor(['B', 'A']).set('baz')
-
+    async def test_range_all_keys(self, tree):
         result = await tree.range()
         assert len(result) == 3
         assert result[0].key == ['A', 'A']
@@ -350,14 +422,7 @@ class TestDtRange(TestCase):
         assert result[2].key == ['B', 'A']
         assert result[2].value == 'baz'
 
-    @async_test
-    async def test_range_first(self):
-        tree = session.tree(random_tree())
-
-        await tree.cursor(['A', 'A']).set('foo')
-        await tree.cursor(['A', 'B']).set('bar')
-        await tree.cursor(['B', 'A']).set('baz')
-
+    async def test_range_first(self, tree):
         result = await tree.range(first=['A', 'A'])
         assert len(result) == 2
         assert result[0].key == ['A', 'B']
@@ -365,14 +430,7 @@ class TestDtRange(TestCase):
         assert result[1].key == ['B', 'A']
         assert result[1].value == 'baz'
 
-    @async_test
-    async def test_range_last(self):
-        tree = session.tree(random_tree())
-
-        await tree.cursor(['A', 'A']).set('foo')
-        await tree.cursor(['A', 'B']).set('bar')
-        await tree.cursor(['B', 'A']).set('baz')
-
+    async def test_range_last(self, tree):
         result = await tree.range(last=['A', 'B'])
         assert len(result) == 2
         assert result[0].key == ['A', 'A']
@@ -380,14 +438,7 @@ class TestDtRange(TestCase):
         assert result[1].key == ['A', 'B']
         assert result[1].value == 'bar'
 
-    @async_test
-    async def test_range_limit(self):
-        tree = session.tree(random_tree())
-
-        await tree.cursor(['A', 'A']).set('foo')
-        await tree.cursor(['A', 'B']).set('bar')
-        await tree.cursor(['B', 'A']).set('baz')
-
+    async def test_range_limit(self, tree):
         result = await tree.range(limit=2)
         assert len(result) == 2
         assert result[0].key == ['A', 'A']
@@ -396,9 +447,8 @@ class TestDtRange(TestCase):
         assert result[1].value == 'bar'
 
 
-class TestKvBatch(TestCase):
-    @async_test
-    async def test_batch_set(self):
+class TestKvBatch:
+    async def test_batch_set(self, session):
         batch = session.batch_manual()
         p1 = random_partition()
         p2 = random_partition()
@@ -411,24 +461,45 @@ class TestKvBatch(TestCase):
 
         await batch.send()
 
-        assert '111' == (await session.get_entry(p1, ['aaa'])).value
-        assert '222' == (await session.get_entry(p1, ['bbb'])).value
-        assert '333' == (await session.get_entry(p2, ['aaa'])).value
-        assert '444' == (await session.get_entry(p2, ['bbb'])).value
-        assert '555' == (await session.get_entry(p2, ['ccc'])).value
-
-    @async_test
-    async def test_batch_set_awaitable(self):
+        e1, e2, e3, e4, e5 = await session.get_entries([
+            (p1, ['aaa']),
+            (p1, ['bbb']),
+            (p2, ['aaa']),
+            (p2, ['bbb']),
+            (p2, ['ccc']),
+        ])
+        assert '111' == e1.value
+        assert '222' == e2.value
+        assert '333' == e3.value
+        assert '444' == e4.value
+        assert '555' == e5.value
+
+    async def test_batch_set_awaitable(self, session):
         batch = session.batch_manual()
         p1 = random_partition()
 
-        f = session.entry(p1, ['aaa']).set('111', batch=batch)
+        entry = session.entry(p1, ['aaa'])
+        f = entry.set('111', batch=batch)
         await batch.send()
 
-        asyncio.wait_for(1.0, f)
+        version = await asyncio.wait_for(f, 1.0)
+        assert version > 0
+        assert version == entry.version
+        assert '111' == entry.value
 
-    @async_test
-    async def test_batch_cas(self):
+    async def test_batch_updates_entry(self, session):
+        batch = session.batch_manual()
+        entry = session.entry(random_partition(), ['aaa'])
+
+        # результат операции не ожидается, но Entry всё равно получает новую версию
+        entry.set('111', batch=batch)
+        await batch.send()
+
+        assert entry.version > 0
+        await entry.cas('222')
+        assert '222' == (await entry.get())
+
+    async def test_batch_cas(self, session):
         batch = session.batch_manual()
         p1 = random_partition()
 
@@ -438,9 +509,8 @@ class TestKvBatch(TestCase):
         assert '111' == (await session.get_entry(p1, ['aaa'])).value
 
 
-class IndexTest(TestCase):
-    @async_test
-    async def test_set_index(self):
+class IndexTest:
+    async def test_set_index(self, session):
         partition = random_partition()
         indexed = session.partition_index(partition)
 
@@ -455,8 +525,7 @@ class IndexTest(TestCase):
         result = await indexed.get_indexes()
         assert indexes == result
 
-    @async_test
-    async def test_get_indexes_values(self):
+    async def test_get_indexes_values(self, session):
         partition = random_partition()
         indexed = session.partition_index(partition)
 
@@ -469,13 +538,16 @@ class IndexTest(TestCase):
                 IndexField('foo', IndexFieldType.string, IndexFieldOrder.ascending),
             ]
         }
+        # оба запроса меняют схему одного keyspace'а, поэтому выполняются последовательно
         await indexed.set_index(1, indexes[1])
         await indexed.set_index(2, indexes[2])
 
-        await (session.entry(partition, ['111']).set({'foo': 'aaa', 'bar': 123}, reindex=True))
-        await (session.entry(partition, ['222']).set({'foo': 'aaa', 'bar': 456}, reindex=True))
-        await (session.entry(partition, ['333']).set({'foo': 'aaa', 'bar': 789}, reindex=True))
-        await (session.entry(partition, ['444']).set({'foo': 'bbb', 'bar': 777}, reindex=True))
+        batch = session.batch_manual()
+        session.entry(partition, ['111']).set({'foo': 'aaa', 'bar': 123}, reindex=True, batch=batch)
+        session.entry(partition, ['222']).set({'foo': 'aaa', 'bar': 456}, reindex=True, batch=batch)
+        session.entry(partition, ['333']).set({'foo': 'aaa', 'bar': 789}, reindex=True, batch=batch)
+        session.entry(partition, ['444']).set({'foo': 'bbb', 'bar': 777}, reindex=True, batch=batch)
+        await batch.send()
 
         result = await indexed.query({'foo': QueryCondition(eq='aaa')})
         assert [['111'], ['222'], ['333']] == [e.clustering for e in result]
@@ -488,4 +560,4 @@ class IndexTest(TestCase):
 
 
 if __name__ == '__main__':
-    main()
+    pytest.main([__file__])